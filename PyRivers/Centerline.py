@@ -2,10 +2,13 @@ import os
 import timeit
 import math
 import copy
+import multiprocessing
 
 import pandas
 import scipy
+import scipy.sparse.csgraph
 from scipy import spatial
+from scipy import ndimage
 from skimage import measure, draw, morphology, feature, graph
 from skimage.morphology import medial_axis, skeletonize, thin, binary_closing
 import numpy as np
@@ -13,27 +16,19 @@ import rasterio
 from matplotlib import pyplot as plt
 import skfmm
 
+from PyRivers import RasterHelpers
 
-def getLargest(mask):
-    labels = measure.label(mask)
-     # assume at least 1 CC
-    assert( labels.max() != 0 )
 
+def getLargest(mask, connectivity=2, downsample=None):
     # Find largest connected component
-    bins = np.bincount(labels.flat)[1:] 
-    cc = labels == np.argmax(np.bincount(labels.flat)[1:])+1
+    cc = RasterHelpers.largestComponent(mask, connectivity, downsample)
 
     return cc
 
 
 def getCenterline(mask):
-    labels = measure.label(mask)
-     # assume at least 1 CC
-    assert( labels.max() != 0 )
-
     # Find largest connected component
-    bins = np.bincount(labels.flat)[1:] 
-    cc = labels == np.argmax(np.bincount(labels.flat)[1:])+1
+    cc = RasterHelpers.largestComponent(mask)
 
     # Find skeletonized centerline
 #    cc = morphology.binary_closing(cc)
@@ -46,36 +41,124 @@ def getCenterline(mask):
     return skeleton 
 
 
-def findAllIntersections(centerline):
-    rr, cc = np.where(centerline)
+def skeletonizeTile(tile):
+    """
+    Skeletonizes one tile the same way as getCenterline
+    """
+    skeleton = skeletonize(tile, method='lee')
+
+    return thin(skeleton)
+
+
+def tileRadius(tile):
+    """
+    Largest distance from a channel pixel to the bank in a tile. The 
+    tile edges don't count as bank, so this is never an underestimate
+    """
+    if not tile.any():
+        return 0
+
+    return ndimage.distance_transform_edt(tile).max()
+
+
+def getCenterlineTiled(mask, tile_size=2048, overlap=None, processes=None):
+    """
+    Tiled version of getCenterline for masks too big to skeletonize in 
+    one go. Tiles are skeletonized in parallel with an overlap on every
+    side and only their cores are stitched back together. 
+    Thinning only moves in from the banks as far as the channel's half 
+    width, so once the overlap is wider than that the stitched skeleton 
+    is the same as the full image one. By default the overlap is found
+    from the largest distance to the bank in any tile
+    """
+    cc = RasterHelpers.largestComponent(mask)
+    h, w = cc.shape
+
+    cores = [
+        (r0, min(r0 + tile_size, h), c0, min(c0 + tile_size, w))
+        for r0 in range(0, h, tile_size)
+        for c0 in range(0, w, tile_size)
+    ]
+
+    skeleton = np.zeros(cc.shape, dtype=bool)
+    with multiprocessing.Pool(processes) as pool:
+        if overlap is None:
+            radii = pool.map(
+                tileRadius, 
+                [cc[r0:r1, c0:c1] for r0, r1, c0, c1 in cores]
+            )
+            overlap = int(math.ceil(max(radii))) + 8
+
+        # Pad every tile with the overlap
+        tiles = []
+        for r0, r1, c0, c1 in cores:
+            padded = (
+                max(r0 - overlap, 0), 
+                min(r1 + overlap, h), 
+                max(c0 - overlap, 0), 
+                min(c1 + overlap, w)
+            )
+            if cc[padded[0]:padded[1], padded[2]:padded[3]].any():
+                tiles.append(((r0, r1, c0, c1), padded))
 
-    rows = []
-    cols = []
-    # Get neighboring pixels
-    for r, c in zip(rr, cc):
-        window = centerline[r-1:r+2, c-1:c+2]
+        results = pool.imap(
+            skeletonizeTile,
+            (cc[pr0:pr1, pc0:pc1] for core, (pr0, pr1, pc0, pc1) in tiles)
+        )
 
-        if len(window[window]) > 3:
-            rows.append(r)
-            cols.append(c)
+        # Stitch the tile cores together
+        for ((r0, r1, c0, c1), (pr0, pr1, pc0, pc1)), tile in zip(
+            tiles, 
+            results
+        ):
+            skeleton[r0:r1, c0:c1] = tile[
+                r0 - pr0:r1 - pr0, 
+                c0 - pc0:c1 - pc0
+            ]
+
+    return skeleton
+
+
+def countNeighbors(centerline):
+    """
+    Number of 8-connected centerline neighbors of every pixel. Pixels
+    outside the image count as empty
+    """
+    centerline = np.asarray(centerline, dtype=bool)
+    kernel = np.ones((3, 3), dtype=np.uint8)
+    kernel[1, 1] = 0
+
+    return ndimage.convolve(
+        centerline.view(np.uint8), 
+        kernel, 
+        mode='constant', 
+        cval=0
+    )
 
-    return np.array([cols, rows]).transpose()
 
+def findEndpointsAndIntersections(centerline):
+    """
+    Finds the endpoints (at most 1 neighbor) and intersections (3 or more
+    neighbors) of the centerline in one pass. Both are [col, row] arrays
+    """
+    centerline = np.asarray(centerline, dtype=bool)
+    neighbors = countNeighbors(centerline)
 
-def findAllEndpoints(centerline):
-    rr, cc = np.where(centerline)
+    rows, cols = np.nonzero(centerline & (neighbors <= 1))
+    endpoints = np.array([cols, rows]).transpose()
 
-    rows = []
-    cols = []
-    # Get neighboring pixels
-    for r, c in zip(rr, cc):
-        window = centerline[r-1:r+2, c-1:c+2]
+    rows, cols = np.nonzero(centerline & (neighbors >= 3))
+    intersections = np.array([cols, rows]).transpose()
 
-        if len(window[window]) < 3:
-            rows.append(r)
-            cols.append(c)
+    return endpoints, intersections
 
-    return np.array([cols, rows]).transpose()
+
+def findAllIntersections(centerline):
+    return findEndpointsAndIntersections(centerline)[1]
+
+
+def findAllEndpoints(centerline):
+    return findEndpointsAndIntersections(centerline)[0]
 
 
 def findRiverEndpoints(endpoints, es):
@@ -96,72 +179,134 @@ def findRiverEndpoints(endpoints, es):
 
 
 def fillHoles(mask, thresh=40):
-    # Find contours
-    contours = measure.find_contours(mask, 0.8)
-    # Display the image and plot all contours found
-    for contour in contours:
-        # Get polygon
-        poly = draw.polygon(contour[:, 0], contour[:, 1])
-        print(poly)
-        area = (
-            (poly[0].max() - poly[0].min() + 1)
-            * (poly[1].max() - poly[1].min() + 1)
-        )
-        # Filter by size
-        if area < thresh:
-            draw.set_color(
-                mask, 
-                poly, 
-                True 
-            )
+    """
+    Fills the patches of background whose bounding box covers less than
+    thresh pixels. The background is labelled once, 8-connected like 
+    the contours that used to trace them. Small notches on the image 
+    edge count too, as they did with the contours. 
+    Fills mask in place and returns it
+    """
+    background = ~np.asarray(mask, dtype=bool)
+    labels = np.empty(
+        background.shape, 
+        dtype=RasterHelpers.labelDtype(np.count_nonzero(background))
+    )
+    nlabels = ndimage.label(
+        background, 
+        structure=np.ones((3, 3), dtype=bool), 
+        output=labels
+    )
+    if nlabels == 0:
+        return mask
+
+    # Bounding box area of each label
+    boxes = np.array([
+        (box[0].stop - box[0].start) * (box[1].stop - box[1].start)
+        for box in ndimage.find_objects(labels)
+    ])
+    fill = np.zeros(nlabels + 1, dtype=bool)
+    fill[1:] = boxes < thresh
+
+    mask[fill[labels]] = True
 
     return mask
 
 
-def removeSmallSegments(centerline, intersections, endpoints, thresh):
+def routeWindow(shape, start, end, pad):
+    """
+    Row and column slices of the box around two [row, col] pixels,
+    grown by pad and clipped to the image
+    """
+    rows = slice(
+        max(min(start[0], end[0]) - pad, 0), 
+        min(max(start[0], end[0]) + pad + 1, shape[0])
+    )
+    cols = slice(
+        max(min(start[1], end[1]) - pad, 0), 
+        min(max(start[1], end[1]) + pad + 1, shape[1])
+    )
+
+    return rows, cols
+
+
+def removeSmallSegments(centerline, intersections, endpoints, thresh,
+                        costs=None, bounded=True):
+    """
+    Removes the lines from each endpoint to its nearest intersection 
+    that cost less than thresh to route along. 
+    Every step costs at least 1 and moves at most one pixel, so a route
+    cheaper than thresh never leaves the box thresh pixels around the 
+    endpoint. With bounded, each search only runs over that box and 
+    endpoints farther than thresh from their intersection are skipped.
+    costs can be passed in to reuse one cost array between calls; the 
+    removed pixels are updated in it
+    """
     tree = spatial.KDTree(intersections)
-    costs = np.where(centerline, 1, 1000)
+    if costs is None:
+        costs = np.where(centerline, 1, 1000)
+    pad = int(math.ceil(thresh))
     removed = 0
+    paths = []
     for point in endpoints:
         distance, i = tree.query(point)
+        start = (int(point[1]), int(point[0]))
+        end = (int(intersections[i][1]), int(intersections[i][0]))
+
+        if bounded:
+            if max(abs(start[0] - end[0]), abs(start[1] - end[1])) >= thresh:
+                continue
+            rows, cols = routeWindow(costs.shape, start, end, pad)
+        else:
+            rows, cols = slice(None), slice(None)
+        r0 = rows.start or 0
+        c0 = cols.start or 0
+
         path, dist = graph.route_through_array(
-            costs, 
-            start=(point[1], point[0]),
-            end=(intersections[i][1], intersections[i][0]),
+            costs[rows, cols], 
+            start=(start[0] - r0, start[1] - c0),
+            end=(end[0] - r0, end[1] - c0),
             fully_connected=True
         )
 
-        path = np.array(path)
+        path = np.array(path) + [r0, c0]
         if dist < thresh:
             centerline[path[:,0], path[:,1]] = False
+            paths.append(path)
             removed += 1
         else:
             continue
         
     centerline[intersections[:,1], intersections[:,0]] = True
 
+    # Keep the costs in step with the centerline for the next call
+    if paths:
+        path = np.concatenate(paths)
+        costs[path[:,0], path[:,1]] = 1000
+    costs[intersections[:,1], intersections[:,0]] = 1
+
     return centerline, removed
 
 
-def cleanCenterline(centerline, es, thresh=10000):
+def routeCleanCenterline(centerline, river_endpoints, thresh):
+    """
+    The original cleanCenterline loop: routes every endpoint to its 
+    nearest intersection with removeSmallSegments until a pass removes
+    no more than the two river ends. One cost array is kept in step 
+    with the centerline for all of the passes
+    """
+    costs = np.where(centerline, 1, 1000)
     removed = 999
-    centerline = getLargest(centerline)
-    endpoints = findAllEndpoints(centerline)
-    # Find the terminal endpoints
-    river_endpoints = findRiverEndpoints(endpoints, es)
     while removed > 2:
         # Find the all endpoints in the centerline
         endpoints = findAllEndpoints(centerline)
         # Add an intersection
         for end in river_endpoints:
-            centerline[
-                int(end[1]-1):int(end[1]+2),
-                int(end[0]
-            )] = 1
-            centerline[
-                int(end[1]), 
-                int(end[0]-1):int(end[0]+2)
-            ] = 1
+            rows = slice(int(end[1]-1), int(end[1]+2))
+            cols = slice(int(end[0]-1), int(end[0]+2))
+            centerline[rows, int(end[0])] = 1
+            centerline[int(end[1]), cols] = 1
+            costs[rows, int(end[0])] = 1
+            costs[int(end[1]), cols] = 1
 
         # Find all intersections
         intersections = findAllIntersections(centerline)
@@ -171,7 +316,8 @@ def cleanCenterline(centerline, es, thresh=10000):
             centerline,
             intersections, 
             endpoints,
-            thresh
+            thresh,
+            costs=costs
         )
         print(removed)
 
@@ -186,7 +332,86 @@ def cleanCenterline(centerline, es, thresh=10000):
             int(end[0]-1):int(end[0]+2)
         ] = 0
 
-    return centerline, river_endpoints
+    return centerline
+
+
+def cleanCenterline(centerline, es, thresh=10000, method='graph'):
+    """
+    Removes the spurs shorter than thresh, keeping the ones that end at
+    the river endpoints (found from es). 
+    method='graph' prunes in one traversal with skeletonGraph.pruneSpurs.
+    Spurs are measured along the skeleton to the junction they hang off,
+    so the main line stays in one piece and the river endpoint pixels
+    stay in the centerline.
+    method='route' is the original loop (routeCleanCenterline) and gives
+    the old output. It routes each endpoint to the straight-line nearest
+    intersection, which can cut through the main line and break it up,
+    and it erases the pixels around the river endpoints at the end.
+    On skeletons with many spurs the two methods can differ by hundreds
+    of pixels
+    Returns the centerline and the river endpoints
+    """
+    centerline = getLargest(centerline)
+    endpoints = findAllEndpoints(centerline)
+    # Find the terminal endpoints
+    river_endpoints = findRiverEndpoints(endpoints, es)
+
+    if method == 'route':
+        centerline = routeCleanCenterline(
+            centerline, 
+            river_endpoints, 
+            thresh
+        )
+        return centerline, river_endpoints
+
+    # Remove all the small bits in one traversal of the skeleton graph,
+    # keeping the spurs that end at the river endpoints
+    skeleton = buildGraph(centerline)
+    keep = [skeleton.nearestNode(end) for end in river_endpoints]
+    removed = skeleton.pruneSpurs(thresh, keep)
+    print(removed)
+
+    return skeleton.toRaster(), river_endpoints
+
+
+def cleanCenterlineSweep(centerline, es, thresh=100, step=10, 
+                         maxdistance=50):
+    """
+    Finds the largest threshold (thresh, thresh - step, ...) where 
+    pruning every spur, including the ones at the river ends, still 
+    leaves the centerline within maxdistance of both river endpoints 
+    (the getCenterlineExtent check). A threshold that is too big eats 
+    back the river ends. The centerline is then cleaned at that 
+    threshold keeping the river ends, like cleanCenterline. 
+    The skeleton graph is built once and each threshold only re-prunes 
+    it, instead of running cleanCenterline from scratch every time.
+    Returns the centerline, the river endpoints and the threshold used
+    """
+    centerline = getLargest(centerline)
+    endpoints = findAllEndpoints(centerline)
+    river_endpoints = findRiverEndpoints(endpoints, es)
+
+    skeleton = buildGraph(centerline)
+    incident = skeleton.incidentEdges()
+    alive = skeleton.edge_alive.copy()
+
+    # Nothing is pruned at a threshold of 0
+    while thresh > 0:
+        print('Trying threshold: ', thresh)
+        skeleton.edge_alive[:] = alive
+        skeleton.pruneSpurs(thresh, incident=incident)
+        if skeleton.extent(river_endpoints, maxdistance):
+            break
+        thresh -= step
+    else:
+        thresh = 0
+
+    # Clean with the threshold found, keeping the river ends
+    skeleton.edge_alive[:] = alive
+    keep = [skeleton.nearestNode(end) for end in river_endpoints]
+    skeleton.pruneSpurs(thresh, keep, incident=incident)
+
+    return skeleton.toRaster(), river_endpoints, thresh
 
 
 def getCenterlineExtent(centerline, river_endpoints, maxdistance=500):
@@ -209,6 +434,385 @@ def getCenterlineExtent(centerline, river_endpoints, maxdistance=500):
         return True
 
 
+def orderCenterline(centerline, es):
+    """
+    Ordered [row, col] pixels of a cleaned centerline between its river 
+    endpoints, from the es[0] end to the es[1] end (e.g. upstream to 
+    downstream). Walks the skeleton into a skeletonGraph and takes the 
+    shortest path between the two ends, so any braid left is crossed 
+    along the shorter branch.
+    Returns an int32 (N, 2) array
+    """
+    endpoints = findAllEndpoints(centerline)
+    river_endpoints = findRiverEndpoints(endpoints, es)
+
+    skeleton = buildGraph(centerline)
+    source, target = [
+        skeleton.nearestNode(end) for end in river_endpoints
+    ]
+
+    return skeleton.orderedPath(source, target)
+
+
+# Offsets to the 8 neighbors of a pixel and the length of each step
+NEIGHBORS = np.array([
+    (-1, -1), (-1, 0), (-1, 1),
+    (0, -1), (0, 1),
+    (1, -1), (1, 0), (1, 1),
+])
+STEPS = np.hypot(NEIGHBORS[:, 0], NEIGHBORS[:, 1])
+
+
+class skeletonGraph(object):
+    """
+    Compact graph of a skeleton. Nodes are the skeleton pixels that 
+    don't have exactly 2 neighbors (endpoints and intersections) and 
+    edges are the chains of pixels between them. Everything is kept in
+    flat arrays:
+        node_rows, node_cols - pixel of each node
+        edge_start, edge_end - nodes at the two ends of each edge
+        edge_length - length of each edge in pixels
+        path_offsets, path_rows, path_cols - the pixels strictly between
+            the two nodes of edge i, in order from edge_start, are
+            path_rows[path_offsets[i]:path_offsets[i + 1]]
+        edge_alive - edges that haven't been pruned
+    """
+
+    def __init__(self, shape, node_rows, node_cols, edge_start, edge_end,
+                 edge_length, path_offsets, path_rows, path_cols):
+        self.shape = shape
+        self.node_rows = node_rows
+        self.node_cols = node_cols
+        self.edge_start = edge_start
+        self.edge_end = edge_end
+        self.edge_length = edge_length
+        self.path_offsets = path_offsets
+        self.path_rows = path_rows
+        self.path_cols = path_cols
+        self.edge_alive = np.ones(len(edge_start), dtype=bool)
+
+        # Nodes that were never part of an edge (single pixels)
+        self.isolated = self.degree() == 0
+
+    def degree(self):
+        """
+        Number of live edges at each node (self loops count twice)
+        """
+        alive = self.edge_alive
+        return (
+            np.bincount(
+                self.edge_start[alive], 
+                minlength=len(self.node_rows)
+            )
+            + np.bincount(
+                self.edge_end[alive], 
+                minlength=len(self.node_rows)
+            )
+        )
+
+    def endpoints(self):
+        """
+        Nodes at the end of a line
+        """
+        return np.flatnonzero(self.degree() == 1)
+
+    def intersections(self):
+        """
+        Nodes where three or more edges meet
+        """
+        return np.flatnonzero(self.degree() >= 3)
+
+    def edgePath(self, edge, reverse=False):
+        """
+        All of the [row, col] pixels of an edge including its two nodes
+        """
+        start, end = self.edge_start[edge], self.edge_end[edge]
+        inner = slice(self.path_offsets[edge], self.path_offsets[edge + 1])
+        path = np.concatenate([
+            [[self.node_rows[start], self.node_cols[start]]],
+            np.array([self.path_rows[inner], self.path_cols[inner]]).T,
+            [[self.node_rows[end], self.node_cols[end]]],
+        ]).astype(np.int32)
+
+        if reverse:
+            return path[::-1]
+
+        return path
+
+    def pixels(self):
+        """
+        [row, col] of every pixel in the live graph
+        """
+        inner = np.repeat(self.edge_alive, np.diff(self.path_offsets))
+        nodes = np.flatnonzero((self.degree() > 0) | self.isolated)
+
+        return np.concatenate([
+            np.array([self.node_rows[nodes], self.node_cols[nodes]]).T,
+            np.array([self.path_rows[inner], self.path_cols[inner]]).T,
+        ]).astype(np.int32)
+
+    def toRaster(self):
+        """
+        Paints the live graph back into a boolean skeleton image
+        """
+        raster = np.zeros(self.shape, dtype=bool)
+        pixels = self.pixels()
+        raster[pixels[:, 0], pixels[:, 1]] = True
+
+        return raster
+
+    def nearestNode(self, point):
+        """
+        Node closest to an [x (col), y (row)] point
+        """
+        return np.argmin(
+            (self.node_cols - point[0]) ** 2 
+            + (self.node_rows - point[1]) ** 2
+        )
+
+    def incidentEdges(self):
+        """
+        List of the live edges at each node
+        """
+        incident = [[] for node in range(len(self.node_rows))]
+        for edge in np.flatnonzero(self.edge_alive):
+            start, end = self.edge_start[edge], self.edge_end[edge]
+            incident[start].append(edge)
+            if end != start:
+                incident[end].append(edge)
+
+        return incident
+
+    def walkSpur(self, tip, degree, incident):
+        """
+        Follows the line from an endpoint through any nodes with 2 edges.
+        Returns the edges walked, the node it stops at and its length
+        """
+        edges = []
+        length = 0.
+        node = tip
+        previous = None
+        while True:
+            edge = next(
+                e for e in incident[node] 
+                if e != previous and self.edge_alive[e]
+            )
+            edges.append(edge)
+            length += self.edge_length[edge]
+
+            if self.edge_start[edge] == node:
+                other = self.edge_end[edge]
+            else:
+                other = self.edge_start[edge]
+
+            if degree[other] != 2 or other == tip:
+                return edges, other, length
+            node, previous = other, edge
+
+    def pruneSpurs(self, thresh, keep=(), rounds=None, incident=None):
+        """
+        Removes the spurs shorter than thresh. Each spur is walked from 
+        its endpoint to the intersection it hangs off. All of the spurs
+        in a round are measured before any are removed (like one pass of
+        cleanCenterline). Removing them can only expose new spurs at 
+        those intersections, so only they are checked in the next round.
+        Stops when a round removes nothing (or after rounds). 
+        Spurs that end at a node in keep (e.g. the river endpoints) stay.
+        incident can be passed in from incidentEdges to save rebuilding it.
+        Returns the number of spurs removed
+        """
+        degree = self.degree()
+        if incident is None:
+            incident = self.incidentEdges()
+        keep = set(int(node) for node in keep)
+
+        tips = [t for t in np.flatnonzero(degree == 1) if t not in keep]
+        removed = 0
+        n = 0
+        while tips and (rounds is None or n < rounds):
+            n += 1
+
+            # Measure every spur first
+            spurs = []
+            for tip in tips:
+                if degree[tip] != 1:
+                    continue
+                edges, junction, length = self.walkSpur(tip, degree, incident)
+                if degree[junction] >= 3 and length < thresh:
+                    spurs.append((edges, junction))
+
+            # Then remove them
+            for edges, junction in spurs:
+                for edge in edges:
+                    self.edge_alive[edge] = False
+                    degree[self.edge_start[edge]] -= 1
+                    degree[self.edge_end[edge]] -= 1
+            removed += len(spurs)
+
+            # Intersections left with one edge are the new tips
+            tips = [
+                junction for edges, junction in spurs 
+                if degree[junction] == 1 and junction not in keep
+            ]
+
+        return removed
+
+    def prune(self, thresh, keep=()):
+        """
+        One round of pruneSpurs
+        """
+        return self.pruneSpurs(thresh, keep, rounds=1)
+
+    def orderedPath(self, source, target):
+        """
+        [row, col] pixels of the shortest path between two nodes, in 
+        order from source to target
+        """
+        alive = np.flatnonzero(self.edge_alive)
+        n = len(self.node_rows)
+
+        # Shortest edge between each pair of nodes
+        order = alive[np.argsort(self.edge_length[alive])[::-1]]
+        best = {}
+        for edge in order:
+            a, b = self.edge_start[edge], self.edge_end[edge]
+            best[(a, b)] = edge
+            best[(b, a)] = edge
+        pairs = np.array(list(best.keys()), dtype=np.int64).reshape(-1, 2)
+        lengths = self.edge_length[list(best.values())]
+        matrix = scipy.sparse.csr_matrix(
+            (lengths, (pairs[:, 0], pairs[:, 1])), 
+            shape=(n, n)
+        )
+
+        distances, predecessors = scipy.sparse.csgraph.dijkstra(
+            matrix, 
+            indices=source, 
+            return_predecessors=True
+        )
+        if not np.isfinite(distances[target]):
+            raise ValueError('Nodes are not connected')
+
+        # Walk back from the target
+        nodes = [target]
+        while nodes[-1] != source:
+            nodes.append(predecessors[nodes[-1]])
+        nodes = nodes[::-1]
+
+        path = [[[self.node_rows[source], self.node_cols[source]]]]
+        for a, b in zip(nodes[:-1], nodes[1:]):
+            edge = best[(a, b)]
+            path.append(self.edgePath(
+                edge, 
+                reverse=self.edge_start[edge] != a
+            )[1:])
+
+        return np.concatenate(path).astype(np.int32)
+
+    def extent(self, river_endpoints, maxdistance=500):
+        """
+        Same check as getCenterlineExtent on the graph: are both river
+        endpoints within maxdistance of the centerline
+        """
+        tree = spatial.cKDTree(self.pixels())
+        distance, neighbor = tree.query(
+            [[endpoint[1], endpoint[0]] for endpoint in river_endpoints]
+        )
+
+        return bool((distance <= maxdistance).all())
+
+
+def buildGraph(skeleton):
+    """
+    Builds the skeletonGraph in one walk over the skeleton pixels
+    """
+    skeleton = np.asarray(skeleton, dtype=bool)
+    h, w = skeleton.shape
+    neighbors = countNeighbors(skeleton)
+
+    # Pad by one so walking never falls off the image
+    pw = w + 2
+    flat = np.pad(skeleton, 1).ravel()
+    is_node = np.pad(skeleton & (neighbors != 2), 1).ravel()
+    node_index = np.flatnonzero(is_node)
+    node_flat = list(node_index)
+    offsets = NEIGHBORS[:, 0] * pw + NEIGHBORS[:, 1]
+    visited = np.zeros(flat.size, dtype=bool)
+
+    edge_start = []
+    edge_end = []
+    edge_length = []
+    path_offsets = [0]
+    paths = []
+
+    def walk(a, start, first, step):
+        # Follow a chain of 2 neighbor pixels until it hits a node
+        prev, cur, length = start, first, step
+        while not is_node[cur]:
+            visited[cur] = True
+            paths.append(cur)
+            for k in range(8):
+                nxt = cur + offsets[k]
+                if nxt != prev and flat[nxt]:
+                    break
+            prev, cur, length = cur, nxt, length + STEPS[k]
+            if cur == start:
+                break
+
+        if cur == start:
+            b = a
+        else:
+            b = np.searchsorted(node_index, cur)
+        edge_start.append(a)
+        edge_end.append(b)
+        edge_length.append(length)
+        path_offsets.append(len(paths))
+
+    for a, start in enumerate(node_index):
+        for k in range(8):
+            first = start + offsets[k]
+            if not flat[first] or visited[first]:
+                continue
+            # Neighboring nodes share an edge with no pixels between them
+            if is_node[first]:
+                b = np.searchsorted(node_index, first)
+                if a < b:
+                    edge_start.append(a)
+                    edge_end.append(b)
+                    edge_length.append(STEPS[k])
+                    path_offsets.append(len(paths))
+                continue
+            walk(a, start, first, STEPS[k])
+
+    # Closed loops with no nodes get a node on one of their pixels
+    for start in np.flatnonzero(flat & ~is_node & ~visited):
+        if visited[start]:
+            continue
+        visited[start] = True
+        node_flat.append(start)
+        a = len(node_flat) - 1
+        for k in range(8):
+            first = start + offsets[k]
+            if flat[first]:
+                break
+        walk(a, start, first, STEPS[k])
+
+    node_flat = np.array(node_flat, dtype=np.int64)
+    paths = np.array(paths, dtype=np.int64)
+
+    return skeletonGraph(
+        skeleton.shape,
+        (node_flat // pw - 1).astype(np.int32),
+        (node_flat % pw - 1).astype(np.int32),
+        np.array(edge_start, dtype=np.int64),
+        np.array(edge_end, dtype=np.int64),
+        np.array(edge_length, dtype=np.float64),
+        np.array(path_offsets, dtype=np.int64),
+        (paths // pw - 1).astype(np.int32),
+        (paths % pw - 1).astype(np.int32),
+    )
+
+
 if __name__=='__main__':
 
     root = 'tests/classification/'
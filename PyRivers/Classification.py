@@ -1,18 +1,26 @@
 import os
+import json
 import timeit
 import math
+import multiprocessing
 
+import joblib
 import pandas
 import numpy as np
+import geopandas as gpd
 from sklearn.tree import DecisionTreeClassifier
 from sklearn.model_selection import train_test_split
 from sklearn import tree, metrics
 import rasterio
 from rasterio import plot
+from rasterio import features
+from rasterio.windows import Window
 from matplotlib import pyplot as plt
 from matplotlib.widgets import Button
 from matplotlib.patches import Rectangle
 
+from PyRivers import RasterHelpers
+
 
 class pickData(object):
     text_template = 'x: %0.2f\ny: %0.2f'
@@ -90,21 +98,110 @@ class pickData(object):
             self.events = []
 
 
+class pixelReservoir(object):
+    """
+    Keeps a uniform random sample of at most max_samples training pixels
+    per class while pixels are streamed in (reservoir sampling). 
+    Pixels are stored as float32, which is what the tree is fitted on
+    """
+
+    def __init__(self, nbands, max_samples=100000, seed=0):
+        self.nbands = nbands
+        self.max_samples = max_samples
+        self.rng = np.random.default_rng(seed)
+        self.reservoirs = {}
+        self.seen = {}
+
+    def add(self, surface_class, sample):
+        """
+        Adds a (bands, pixels) sample of one class. Pixels with any NaN 
+        band are dropped since they can't be used to fit the tree
+        """
+        sample = sample[:, ~np.isnan(sample).any(axis=0)]
+        if sample.shape[1] == 0:
+            return
+
+        if surface_class not in self.reservoirs:
+            self.reservoirs[surface_class] = np.empty(
+                (self.nbands, 0), 
+                dtype=np.float32
+            )
+            self.seen[surface_class] = 0
+        reservoir = self.reservoirs[surface_class]
+        seen = self.seen[surface_class]
+
+        # Fill the reservoir until it is full
+        nfill = max(0, min(
+            self.max_samples - reservoir.shape[1], 
+            sample.shape[1]
+        ))
+        if nfill:
+            reservoir = np.concatenate(
+                [reservoir, sample[:, :nfill].astype(np.float32)], 
+                axis=1
+            )
+
+        # Each later pixel t replaces a random slot with probability k/(t+1)
+        rest = sample[:, nfill:]
+        if rest.shape[1]:
+            t = seen + nfill + np.arange(rest.shape[1])
+            slots = (self.rng.random(rest.shape[1]) * (t + 1)).astype(np.int64)
+            keep = slots < self.max_samples
+            reservoir[:, slots[keep]] = rest[:, keep]
+
+        self.reservoirs[surface_class] = reservoir
+        self.seen[surface_class] = seen + sample.shape[1]
+
+    def samples(self):
+        """
+        Returns the kept samples and classes ready for samples2df
+        """
+        samples = []
+        classes = []
+        for surface_class, reservoir in self.reservoirs.items():
+            samples.append(reservoir)
+            classes.append(np.full(reservoir.shape[1], surface_class))
+
+        return samples, classes
+
+
 def dataBox2df(sample, bandnames):
-    height = sample.shape[1] * sample.shape[2]
-    matrix = np.zeros([height, sample.shape[0]])
-    n = 0
-    for i in range(sample.shape[1]):
-        for j in range(sample.shape[2]):
-            matrix[n, :] = sample[:, i, j]
-            n +=1
+    # (bands, rows, cols) -> (pixels, bands)
+    matrix = sample.reshape(sample.shape[0], -1).transpose()
+
+    return pandas.DataFrame(
+        matrix.astype(np.float64), 
+        columns=bandnames
+    )
+
 
-    return pandas.DataFrame(matrix, columns=bandnames)
+def rectToBox(rect):
+    """
+    Converts a picked matplotlib Rectangle to pixel box indexes 
+    [col_min, row_min, col_max, row_max]
+    """
+    # Get indexes at bottom left
+    botleft = rect.get_xy()
+    botleft = [math.ceil(i) for i in botleft]
+
+    # Get indexes at top right
+    topright = [
+        botleft[0] + rect.get_width(),
+        botleft[1] + rect.get_height(),
+    ]
+    topright = [math.ceil(i) for i in topright]
 
+    ys = [botleft[1], topright[1]]
+    xs = [botleft[0], topright[0]]
 
-def generateTrainingData(image, surface_class, bandnames):
-    im = image[2:5, :, :].transpose()
+    return [min(xs), min(ys), max(xs), max(ys)]
 
+
+def pickBoxes(image):
+    """
+    Interactively pick boxes of training pixels on the image.
+    Returns the list of pixel boxes
+    """
     ims = np.zeros([image.shape[1], image.shape[2], 3])
     for i, band in enumerate([2, 1, 0]):
         ims[:,:,i] = plot.adjust_band(image[band,:,:], kind='linear')
@@ -130,56 +227,219 @@ def generateTrainingData(image, surface_class, bandnames):
 
     plt.show()
 
-    # Convert rectangles to DF 
-    df = pandas.DataFrame()
-    for rect in PD.rects:
-        # Get indexes at bottom left
-        botleft = rect.get_xy()
-        botleft = [math.ceil(i) for i in botleft]
+    return [rectToBox(rect) for rect in PD.rects]
+
+
+def saveBoxes(boxes, path):
+    """
+    Saves the training boxes for each class ({class: [box, ...]}) to json
+    """
+    with open(path, 'w') as f:
+        json.dump(
+            {str(k): [[int(i) for i in box] for box in v] 
+             for k, v in boxes.items()}, 
+            f
+        )
+
 
-        # Get indexes at top right
-        topright = [
-            botleft[0] + rect.get_width(),
-            botleft[1] + rect.get_height(),
-        ]
-        topright = [math.ceil(i) for i in topright]
+def loadBoxes(path):
+    """
+    Loads training boxes saved with saveBoxes
+    """
+    with open(path) as f:
+        boxes = json.load(f)
 
-        # Get image rows
-        ys = [botleft[1], topright[1]]
-        xs = [botleft[0], topright[0]]
-        sample = image[:, min(ys):max(ys),min(xs):max(xs)]
-        print(sample.shape)
+    return {int(k): v for k, v in boxes.items()}
 
-        df = pandas.concat(
-            [df, dataBox2df(sample, bandnames)]
-        ).reset_index(drop=True)
 
-    df['class'] = surface_class 
+def samples2df(samples, classes, bandnames, dtype=np.float64):
+    """
+    Builds the training DataFrame once from lists of (bands, pixels) 
+    samples and the class of each pixel
+    """
+    if not samples:
+        samples = [np.empty((len(bandnames), 0))]
+        classes = [np.empty(0, dtype=int)]
+
+    df = pandas.DataFrame(
+        np.concatenate(samples, axis=1).transpose().astype(dtype),
+        columns=bandnames
+    )
+    df['class'] = np.concatenate(classes)
+    print(df.shape)
 
     return df
 
 
-def generateTree(inpath):
+def boxes2df(image, boxes, bandnames):
+    """
+    Pulls the pixels in all of the boxes out of the image in one pass
+    and builds the training DataFrame once. 
+    boxes maps each class to its list of boxes
+    """
+    nbands = image.shape[0]
+    samples = []
+    classes = []
+    for surface_class, class_boxes in boxes.items():
+        for col_min, row_min, col_max, row_max in class_boxes:
+            sample = image[:, row_min:row_max, col_min:col_max]
+            samples.append(sample.reshape(nbands, -1))
+            classes.append(np.full(samples[-1].shape[1], surface_class))
+
+    return samples2df(samples, classes, bandnames)
+
+
+def regionsFromBoxes(boxes, ds):
+    """
+    Converts saved training boxes to (class, window, geometry) regions
+    """
+    full = Window(0, 0, ds.width, ds.height)
+    regions = []
+    for surface_class, class_boxes in boxes.items():
+        for col_min, row_min, col_max, row_max in class_boxes:
+            window = Window(
+                col_min, 
+                row_min, 
+                col_max - col_min, 
+                row_max - row_min
+            )
+            if not rasterio.windows.intersect(window, full):
+                continue
+            regions.append((
+                surface_class, 
+                window.intersection(full), 
+                None
+            ))
+
+    return regions
+
+
+def regionsFromVector(path, ds, class_field='class'):
+    """
+    Reads labelled polygons from a vector file into 
+    (class, window, geometry) regions in the pixel grid of ds
+    """
+    polygons = gpd.read_file(path)
+    if polygons.crs is not None and ds.crs is not None:
+        polygons = polygons.to_crs(ds.crs)
+
+    full = Window(0, 0, ds.width, ds.height)
+    regions = []
+    for surface_class, geom in zip(polygons[class_field], polygons.geometry):
+        # Window of pixels covering the polygon
+        bounds = rasterio.windows.from_bounds(
+            *geom.bounds, 
+            transform=ds.transform
+        )
+        col_off = math.floor(bounds.col_off)
+        row_off = math.floor(bounds.row_off)
+        window = Window(
+            col_off,
+            row_off,
+            math.ceil(bounds.col_off + bounds.width) - col_off,
+            math.ceil(bounds.row_off + bounds.height) - row_off
+        )
+        if not rasterio.windows.intersect(window, full):
+            continue
+        regions.append((int(surface_class), window.intersection(full), geom))
+
+    return regions
+
+
+def loadRegions(path, ds, class_field='class'):
+    """
+    Loads labelled training regions from either a box json (saveBoxes)
+    or any vector file geopandas can read
+    """
+    if path.endswith('.json'):
+        with open(path) as f:
+            content = json.load(f)
+        if 'features' not in content:
+            return regionsFromBoxes(loadBoxes(path), ds)
+
+    return regionsFromVector(path, ds, class_field)
+
+
+def iterRegionSamples(ds, regions):
+    """
+    Reads the (bands, pixels) sample in each region with windowed reads,
+    so the full image is never loaded
+    """
+    for surface_class, window, geom in regions:
+        sample = ds.read(window=window)
+        sample = sample.reshape(sample.shape[0], -1)
+
+        # Only keep the pixels inside the polygon
+        if geom is not None:
+            inside = features.geometry_mask(
+                [geom],
+                out_shape=(int(window.height), int(window.width)),
+                transform=ds.window_transform(window),
+                invert=True
+            )
+            sample = sample[:, inside.reshape(-1)]
+
+        yield surface_class, sample
+
+
+def sampleRegions(ds, regions, bandnames):
+    """
+    Samples the training pixels in each region into a DataFrame
+    """
+    samples = []
+    classes = []
+    for surface_class, sample in iterRegionSamples(ds, regions):
+        samples.append(sample)
+        classes.append(np.full(sample.shape[1], surface_class))
+
+    return samples2df(samples, classes, bandnames)
+
+
+def generateTrainingData(image, surface_class, bandnames, boxes=None):
+    # Pick the boxes if we weren't given any
+    if boxes is None:
+        boxes = pickBoxes(image)
+
+    return boxes2df(image, {surface_class: boxes}, bandnames)
+
+
+def generateTree(inpath, boxpath=None):
     """
     Produces a decision tree classifier that can be used 
-    across multiple images
+    across multiple images. 
+    If boxpath exists the training boxes are loaded from it, otherwise
+    they are picked and saved to boxpath (if given)
     """
     # Load in the image
     ds = rasterio.open(inpath)
     bandnames = ds.descriptions
     image = ds.read()
 
-    # Water
-    print('Pick Water Points')
-    water_df = generateTrainingData(image, 1, bandnames)
+    if boxpath is not None and os.path.exists(boxpath):
+        boxes = loadBoxes(boxpath)
+    else:
+        # Water
+        print('Pick Water Points')
+        water_boxes = pickBoxes(image)
+
+        # Not water
+        print('Pick Non-Water Points')
+        not_water_boxes = pickBoxes(image)
 
-    # Not water
-    print('Pick Non-Water Points')
-    not_water_df = generateTrainingData(image, 0, bandnames)
+        boxes = {1: water_boxes, 0: not_water_boxes}
+        if boxpath is not None:
+            saveBoxes(boxes, boxpath)
 
     # Set up whole df
-    df = pandas.concat([water_df, not_water_df])
+    df = boxes2df(image, boxes, bandnames)
+
+    return fitTree(df, bandnames)
+
 
+def fitTree(df, bandnames):
+    """
+    Fits the decision tree to a training DataFrame
+    """
     # Remove Nan
     df = df.dropna(how='any')
     print(df.head())
@@ -209,41 +469,418 @@ def generateTree(inpath):
     return clf
 
 
-def predictPixels(inpath, opath, clf):
+def trainTree(inpath, regionpath, clfpath=None, class_field='class'):
+    """
+    Non-interactive version of generateTree. Reads the labelled regions
+    from a vector file or box json, samples them with windowed reads,
+    fits the tree and saves it to clfpath (if given) with joblib
+    """
+    with rasterio.open(inpath) as ds:
+        bandnames = ds.descriptions
+        regions = loadRegions(regionpath, ds, class_field)
+        df = sampleRegions(ds, regions, bandnames)
 
-    # Load in the image
-    ds = rasterio.open(inpath)
-    bandnames = ds.descriptions
-    image = ds.read()
+    clf = fitTree(df, bandnames)
 
-    # Reshape to correct shape
-    new_shape = (image.shape[1] * image.shape[2], image.shape[0])
-    image_predict = np.moveaxis(image, 0, -1)
-    img_as_array = image_predict[:, :, :].reshape(new_shape)
-    print('Reshaped from {o} to {n}'.format(
-        o=image.shape,
-        n=img_as_array.shape)
-    )
+    if clfpath is not None:
+        joblib.dump(clf, clfpath, compress=9)
 
-    # Crazy method to predict for each pixel
+    return clf
+
+
+def trainTreeScenes(scenes, clfpath=None, max_samples=100000, 
+                    class_field='class', seed=0):
+    """
+    Fits one tree to training regions from many scenes (e.g. every year 
+    of a river). scenes is a list of (inpath, regionpath) pairs. 
+    Scenes are opened one at a time and at most max_samples pixels per
+    class are kept, so the training set stays bounded
+    """
+    reservoir = None
+    for inpath, regionpath in scenes:
+        print(inpath)
+        with rasterio.open(inpath) as ds:
+            if reservoir is None:
+                bandnames = ds.descriptions
+                reservoir = pixelReservoir(ds.count, max_samples, seed)
+            regions = loadRegions(regionpath, ds, class_field)
+            for surface_class, sample in iterRegionSamples(ds, regions):
+                reservoir.add(surface_class, sample)
+
+    samples, classes = reservoir.samples()
+    df = samples2df(samples, classes, bandnames, dtype=np.float32)
+    clf = fitTree(df, bandnames)
+
+    if clfpath is not None:
+        joblib.dump(clf, clfpath, compress=9)
+
+    return clf
+
+
+class compiledTree(object):
+    """
+    Pure NumPy version of a fitted DecisionTreeClassifier. The split 
+    thresholds are applied to whole band arrays with boolean masks, so
+    there is no per-call sklearn overhead and no (pixels, bands) copy of
+    the image. Gives the same classes as clf.predict
+    """
+
+    def __init__(self, clf):
+        tree_ = clf.tree_
+        if tree_.n_outputs != 1:
+            raise ValueError('Only single output trees can be compiled')
+
+        self.classes_ = clf.classes_
+        self.n_features_in_ = clf.n_features_in_
+        self.children_left = tree_.children_left
+        self.children_right = tree_.children_right
+        self.feature = tree_.feature
+
+        # sklearn compares float32 pixels against float64 thresholds.
+        # Rounding each threshold down to a float32 gives the same split
+        threshold = tree_.threshold.astype(np.float32)
+        over = threshold > tree_.threshold
+        threshold[over] = np.nextafter(threshold[over], np.float32(-np.inf))
+        self.threshold = threshold
+
+        # Side of each split that NaN values go to
+        self.missing_go_to_left = np.asarray(getattr(
+            tree_,
+            'missing_go_to_left',
+            np.zeros(tree_.node_count)
+        )).astype(bool)
+
+        # Class of each leaf
+        self.leaf_class = clf.classes_[np.argmax(tree_.value[:, 0, :], axis=1)]
+
+    def evaluate(self, bands, n):
+        """
+        Evaluates the tree on a list of n long float32 band arrays, one
+        per feature. Only the bands used by the tree need to be set
+        """
+        out = np.empty(n, dtype=self.classes_.dtype)
+
+        # Walk the tree carrying the pixel indices that reach each node
+        stack = [(0, np.arange(n))]
+        while stack:
+            node, idx = stack.pop()
+            if len(idx) == 0:
+                continue
+
+            # Leaf
+            if self.children_left[node] == self.children_right[node]:
+                out[idx] = self.leaf_class[node]
+                continue
+
+            values = bands[self.feature[node]][idx]
+            go_left = values <= self.threshold[node]
+            if self.missing_go_to_left[node]:
+                go_left |= np.isnan(values)
+
+            stack.append((self.children_left[node], idx[go_left]))
+            stack.append((self.children_right[node], idx[~go_left]))
+
+        return out
+
+    def features(self):
+        """
+        Indexes of the bands used by the tree
+        """
+        return np.unique(self.feature[self.feature >= 0])
+
+    def predict(self, X):
+        """
+        Same as clf.predict for a (pixels, bands) array
+        """
+        X = np.asarray(X, dtype=np.float32)
+        bands = [None] * self.n_features_in_
+        for f in self.features():
+            bands[f] = X[:, f]
+
+        return self.evaluate(bands, X.shape[0])
+
+    def predictImage(self, image):
+        """
+        Predicts a (bands, rows, cols) image directly from its bands.
+        Pixels that are NaN in every band are left as NaN
+        """
+        bands = [None] * self.n_features_in_
+        for f in self.features():
+            bands[f] = image[f].reshape(-1).astype(np.float32, copy=False)
+
+        n = image.shape[1] * image.shape[2]
+        predictions = self.evaluate(bands, n).astype(np.float64)
+        predictions[np.isnan(image).all(axis=0).reshape(-1)] = None
+
+        return predictions.reshape(image.shape[1:])
+
+
+def compileTree(clf):
+    """
+    Exports a fitted decision tree to the NumPy evaluator
+    """
+    return compiledTree(clf)
+
+
+def benchmarkTree(clf, image, number=3):
+    """
+    Times clf.predict against the compiled tree on a (bands, rows, cols)
+    image and checks that the two give the same classes
+    """
+    compiled = compileTree(clf)
+
+    # Check they match
+    sk_prediction = predictImage(image, clf)
+    np_prediction = predictImage(image, compiled)
+    match = np.array_equal(sk_prediction, np_prediction, equal_nan=True)
+
+    # Time them
+    sk_time = timeit.timeit(
+        lambda: predictImage(image, clf), 
+        number=number
+    ) / number
+    np_time = timeit.timeit(
+        lambda: predictImage(image, compiled), 
+        number=number
+    ) / number
+    print('sklearn: {s:.3f} s, numpy: {n:.3f} s, speedup: {r:.1f}x'.format(
+        s=sk_time,
+        n=np_time,
+        r=sk_time / np_time
+    ))
+    print('Match: ', match)
+
+    return {
+        'sklearn_seconds': sk_time,
+        'numpy_seconds': np_time,
+        'speedup': sk_time / np_time,
+        'match': match,
+    }
+
+
+def predictArray(img_as_array, clf, chunksize=1000000):
+    """
+    Predicts the class of every row in a (pixels, bands) array.
+    Rows that are all NaN are left as NaN. Valid rows are passed to the
+    classifier in chunks of chunksize so memory stays bounded
+    """
     predictions = np.empty([img_as_array.shape[0],])
     predictions[:] = None
-    for i, row in enumerate(img_as_array):
-        if len(row[~np.isnan(row)]) > 0:
-            predictions[i] = clf.predict(row.reshape(1, len(bandnames)))[0]
 
-    # Reshape our classification map
-    class_prediction = predictions.reshape(image_predict[:, :, 0].shape)
-    print(class_prediction.shape)
-#    class_prediction = class_prediction[0, :, :]
+    # Mask out the empty pixels in one go
+    valid = np.flatnonzero(~np.isnan(img_as_array).all(axis=1))
+
+    # Predict the valid pixels in large chunks
+    for start in range(0, len(valid), chunksize):
+        idx = valid[start:start + chunksize]
+        predictions[idx] = clf.predict(img_as_array[idx])
+
+    return predictions
+
+
+def predictImage(image, clf, chunksize=1000000):
+    """
+    Predicts a (bands, rows, cols) image with either a sklearn tree or a
+    compiledTree. Returns a (rows, cols) array that is NaN where there 
+    is no data
+    """
+    if isinstance(clf, compiledTree):
+        return clf.predictImage(image)
+
+    # Reshape to (pixels, bands)
+    img_as_array = np.moveaxis(image, 0, -1).reshape(
+        (image.shape[1] * image.shape[2], image.shape[0])
+    )
+    predictions = predictArray(img_as_array, clf, chunksize)
+
+    return predictions.reshape(image.shape[1:])
+
+
+def predictionToMask(class_prediction):
+    """
+    Converts a prediction array (NaN where there is no data) to the int8
+    mask that gets written to file
+    """
+    return np.where(
+        np.isnan(class_prediction), 
+        0, 
+        class_prediction
+    ).astype(rasterio.int8)
+
+
+def predictPixels(inpath, opath, clf, chunksize=1000000):
 
-    # Reshape our classification map
-#    class_prediction = class_prediction.reshape(img[:, :, 0].shape)
+    # Load in the image
+    ds = RasterHelpers.openRaster(inpath)
+    image = ds.read()
+
+    # Predict all of the valid pixels
+    class_prediction = predictImage(image, clf, chunksize)
+    print(class_prediction.shape)
 
     # Output Class Predictions
     meta = ds.meta.copy()
-    meta.update({'dtype': rasterio.int8, 'count': 1})
+    meta.update({'driver': 'GTiff', 'dtype': rasterio.int8, 'count': 1})
     with rasterio.open(opath, "w", **meta) as dest:
-        dest.write(class_prediction.astype(rasterio.int8), 1)
+        dest.write(predictionToMask(class_prediction), 1)
 
     return class_prediction 
+
+
+def predictPixelsWindowed(inpath, opath, clf, window_size=None, 
+                          chunksize=1000000):
+    """
+    Streaming version of predictPixels. Reads the image one window at a
+    time, classifies it and writes it straight into the output file, so 
+    peak memory depends on the window size and not the scene size.
+    By default the internal blocks of the GeoTIFF are used as windows
+    """
+    ds = RasterHelpers.openRaster(inpath)
+    meta = ds.meta.copy()
+    meta.update({'driver': 'GTiff', 'dtype': rasterio.int8, 'count': 1})
+    with rasterio.open(opath, "w", **meta) as dest:
+        for window in RasterHelpers.iterWindows(ds, window_size):
+            # Predict and write the window
+            image = ds.read(window=window)
+            class_prediction = predictImage(image, clf, chunksize)
+            dest.write(
+                predictionToMask(class_prediction), 
+                1, 
+                window=window
+            )
+
+    # Only close the dataset if we opened it
+    if ds is not inpath:
+        ds.close()
+
+    return opath
+
+
+# Classifier shared with the pool workers. Set once per worker by
+# initWorker so the tree is not pickled with every task
+WORKER = {}
+
+
+def initWorker(clf):
+    WORKER['clf'] = clf
+    WORKER['datasets'] = {}
+
+
+def predictSceneWorker(task):
+    """
+    Classifies a whole scene inside a pool worker
+    """
+    inpath, opath, window_size, chunksize = task
+
+    start = timeit.default_timer()
+    predictPixelsWindowed(
+        inpath, 
+        opath, 
+        WORKER['clf'], 
+        window_size, 
+        chunksize
+    )
+    seconds = timeit.default_timer() - start
+
+    with rasterio.open(inpath) as ds:
+        pixels = ds.width * ds.height
+
+    return inpath, opath, pixels, seconds
+
+
+def predictTileWorker(task):
+    """
+    Classifies one window of a scene inside a pool worker and hands the
+    int8 mask back to the parent, which does all of the writing
+    """
+    inpath, window, chunksize = task
+
+    # Keep the scene open in the worker between tiles
+    if inpath not in WORKER['datasets']:
+        WORKER['datasets'][inpath] = rasterio.open(inpath)
+    ds = WORKER['datasets'][inpath]
+
+    image = ds.read(window=window)
+    class_prediction = predictImage(image, WORKER['clf'], chunksize)
+
+    return window, predictionToMask(class_prediction)
+
+
+def predictScenes(inpaths, opaths, clf, processes=None, window_size=None,
+                  chunksize=1000000):
+    """
+    Classifies many scenes at once by fanning them out to a process pool.
+    The classifier is sent to each worker once. Reports the throughput 
+    of every scene as it finishes and returns them as a DataFrame
+    """
+    tasks = [
+        (inpath, opath, window_size, chunksize) 
+        for inpath, opath in zip(inpaths, opaths)
+    ]
+
+    data = {
+        'inpath': [],
+        'opath': [],
+        'pixels': [],
+        'seconds': [],
+        'pixels_per_second': [],
+    }
+    with multiprocessing.Pool(
+        processes, 
+        initializer=initWorker, 
+        initargs=(clf,)
+    ) as pool:
+        for inpath, opath, pixels, seconds in pool.imap_unordered(
+            predictSceneWorker, 
+            tasks
+        ):
+            print('{p}: {n} pixels in {s:.1f} s ({r:.0f} pixels/s)'.format(
+                p=inpath,
+                n=pixels,
+                s=seconds,
+                r=pixels / seconds
+            ))
+            data['inpath'].append(inpath)
+            data['opath'].append(opath)
+            data['pixels'].append(pixels)
+            data['seconds'].append(seconds)
+            data['pixels_per_second'].append(pixels / seconds)
+
+    return pandas.DataFrame(data)
+
+
+def predictPixelsParallel(inpath, opath, clf, processes=None, 
+                          window_size=None, chunksize=1000000):
+    """
+    Classifies a single large scene by fanning its tiles out to a 
+    process pool. Only the parent process writes to the output file
+    """
+    start = timeit.default_timer()
+    with rasterio.open(inpath) as ds:
+        meta = ds.meta.copy()
+        windows = list(RasterHelpers.iterWindows(ds, window_size))
+    meta.update({'driver': 'GTiff', 'dtype': rasterio.int8, 'count': 1})
+
+    tasks = [(inpath, window, chunksize) for window in windows]
+    with multiprocessing.Pool(
+        processes, 
+        initializer=initWorker, 
+        initargs=(clf,)
+    ) as pool:
+        with rasterio.open(opath, "w", **meta) as dest:
+            for window, class_mask in pool.imap_unordered(
+                predictTileWorker, 
+                tasks
+            ):
+                dest.write(class_mask, 1, window=window)
+
+    seconds = timeit.default_timer() - start
+    pixels = meta['width'] * meta['height']
+    print('{p}: {n} pixels in {s:.1f} s ({r:.0f} pixels/s)'.format(
+        p=inpath,
+        n=pixels,
+        s=seconds,
+        r=pixels / seconds
+    ))
+
+    return opath
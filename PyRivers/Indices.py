@@ -0,0 +1,100 @@
+import numpy as np
+import rasterio
+
+from PyRivers import RasterHelpers
+
+
+# Position of each band in the image stacks (B, G, R, NIR, SWIR1, SWIR2)
+BANDS = {
+    'blue': 0,
+    'green': 1,
+    'red': 2,
+    'nir': 3,
+    'swir1': 4,
+    'swir2': 5,
+}
+
+# Normalized difference indices as (first band, second band).
+# Can also be a function that takes the dictionary of bands
+INDICES = {
+    'water': ('nir', 'swir1'),
+    'mndwi': ('green', 'swir1'),
+    'ndvi': ('nir', 'red'),
+}
+
+
+def indexBands(names, indices=INDICES):
+    """
+    Finds the bands needed to compute a set of indices
+    """
+    needed = set()
+    for name in names:
+        spec = indices[name]
+        if callable(spec):
+            needed.update(BANDS.keys())
+        else:
+            needed.update(spec)
+
+    return needed
+
+
+def computeIndices(image, names=('water', 'mndwi', 'ndvi'),
+                   indices=INDICES, bands=BANDS):
+    """
+    Computes a set of indices over a (bands, rows, cols) image in one
+    pass. Each band is only converted to float32 once.
+    Pixels with no data (band 0 not > 0) are NaN.
+    Returns a (len(names), rows, cols) float32 array
+    """
+    # Pull out the bands once
+    band_arrays = {
+        band: image[bands[band]].astype(np.float32, copy=False)
+        for band in indexBands(names, indices)
+        if bands[band] < image.shape[0]
+    }
+    nodata = ~(image[0] > 0)
+
+    out = np.empty((len(names),) + image.shape[1:], dtype=np.float32)
+    for i, name in enumerate(names):
+        spec = indices[name]
+        if callable(spec):
+            out[i] = spec(band_arrays)
+        else:
+            out[i] = RasterHelpers.WaterIndex(
+                band_arrays[spec[0]],
+                band_arrays[spec[1]]
+            )
+        out[i][nodata] = np.nan
+
+    return out
+
+
+def indexRaster(inpath, outpath, names=('water', 'mndwi', 'ndvi'),
+                indices=INDICES, bands=BANDS, window_size=None):
+    """
+    Writes a set of indices for a scene (path or open dataset) to a 
+    multi-band float32 GeoTIFF (one band per index, in the order of 
+    names). The scene is read once, window by window
+    """
+    ds = RasterHelpers.openRaster(inpath)
+    meta = ds.meta.copy()
+    meta.update({
+        'driver': 'GTiff',
+        'dtype': 'float32',
+        'count': len(names),
+        'nodata': np.nan
+    })
+    with rasterio.open(outpath, "w", **meta) as dest:
+        for window in RasterHelpers.iterWindows(ds, window_size):
+            image = ds.read(window=window)
+            dest.write(
+                computeIndices(image, names, indices, bands),
+                window=window
+            )
+        dest.descriptions = tuple(names)
+
+    # Only close the dataset if we opened it
+    if ds is not inpath:
+        ds.close()
+
+    return outpath
@@ -1,7 +1,11 @@
 import copy
 import glob
+import multiprocessing
 import os
+import timeit
+from xml.etree import ElementTree
 
+from scipy import ndimage
 from skimage.measure import label   
 from matplotlib import pyplot as plt
 from matplotlib.widgets import Button
@@ -9,6 +13,7 @@ from matplotlib.patches import Rectangle
 import numpy as np
 import rasterio
 from rasterio.merge import merge
+from rasterio.windows import Window
 
 
 class maskEraser(object):
@@ -96,7 +101,41 @@ class maskEraser(object):
             self.draw_box(event)
 
 
-def files_to_mosaic(fps, outpath, write=True):
+def iterWindows(ds, window_size=None):
+    """
+    Yields the windows to stream a dataset through. Uses the internal
+    blocks of the file unless a fixed (square) window_size is given
+    """
+    if window_size is None:
+        for ji, window in ds.block_windows(1):
+            yield window
+        return
+
+    for row_off in range(0, ds.height, window_size):
+        for col_off in range(0, ds.width, window_size):
+            yield Window(
+                col_off,
+                row_off,
+                min(window_size, ds.width - col_off),
+                min(window_size, ds.height - row_off)
+            )
+
+
+def files_to_mosaic(fps, outpath, write=True, stream=False, 
+                    window_size=512, virtual=False):
+    """
+    Merges the files into one mosaic. With stream=True the mosaic is 
+    written window by window (see files_to_mosaic_windowed) and the 
+    output path is returned instead of the array. 
+    With virtual=True nothing is merged: an open virtual mosaic dataset
+    is returned (see files_to_vrt), saved to outpath (a .vrt) if write
+    """
+    if virtual:
+        return files_to_vrt(fps, outpath if write else None)
+
+    if stream:
+        return files_to_mosaic_windowed(fps, outpath, window_size)
+
     src_files_to_mosaic = []
     for fp in fps:
         src = rasterio.open(fp)
@@ -114,16 +153,298 @@ def files_to_mosaic(fps, outpath, write=True):
         }
     )
 
+    for src in src_files_to_mosaic:
+        src.close()
+
     if write:
-        with rasterio.open(outpath, "w", **out_meta) as dest:
-            dest.write(mosaic)
+        # Only a finished mosaic ever sits at outpath
+        partpath = partial_path(outpath)
+        try:
+            with rasterio.open(partpath, "w", **out_meta) as dest:
+                dest.write(mosaic)
+            os.replace(partpath, outpath)
+        finally:
+            if os.path.exists(partpath):
+                os.remove(partpath)
 
     return mosaic
 
 
+def partial_path(outpath):
+    """
+    Hidden path next to outpath to write a file to before it is moved 
+    into place, so an interrupted write never leaves a file at outpath
+    """
+    head, tail = os.path.split(outpath)
+
+    return os.path.join(head, '.{t}.part'.format(t=tail))
+
+
+def mosaic_grid(srcs):
+    """
+    Finds the output grid (transform, width, height) of the mosaic of 
+    the open datasets, the same way rasterio.merge does
+    """
+    res = srcs[0].res
+    west = min(src.bounds.left for src in srcs)
+    south = min(src.bounds.bottom for src in srcs)
+    east = max(src.bounds.right for src in srcs)
+    north = max(src.bounds.top for src in srcs)
+
+    width = int(round((east - west) / res[0]))
+    height = int(round((north - south) / res[1]))
+    transform = rasterio.transform.from_origin(west, north, res[0], res[1])
+
+    return transform, width, height
+
+
+def files_to_mosaic_windowed(fps, outpath, window_size=512, 
+                             compress='deflate'):
+    """
+    Streaming mosaic. Computes the output grid first and then fills it 
+    one window at a time from only the tiles that overlap the window, 
+    so memory depends on window_size and not on the mosaic size.
+    Writes a tiled, compressed GeoTIFF (window_size must be a multiple
+    of 16) to a partial file that is only moved to outpath once every 
+    window is written. Closes all of the inputs when done
+    """
+    partpath = partial_path(outpath)
+    srcs = [rasterio.open(fp) for fp in fps]
+    try:
+        transform, width, height = mosaic_grid(srcs)
+        res = srcs[0].res
+        nodata = srcs[0].nodata
+
+        out_meta = srcs[0].meta.copy()
+        out_meta.update(
+            {
+                "driver": "GTiff",
+                "height": height,
+                "width": width,
+                "transform": transform,
+                "tiled": True,
+                "blockxsize": window_size,
+                "blockysize": window_size,
+                "compress": compress,
+            }
+        )
+
+        with rasterio.open(partpath, "w", **out_meta) as dest:
+            for window in iterWindows(dest, window_size):
+                west, south, east, north = rasterio.windows.bounds(
+                    window, 
+                    transform
+                )
+
+                # Only the tiles that overlap the window
+                overlapping = [
+                    src for src in srcs 
+                    if src.bounds.left < east 
+                    and src.bounds.right > west
+                    and src.bounds.bottom < north 
+                    and src.bounds.top > south
+                ]
+
+                if overlapping:
+                    mosaic, out_trans = merge(
+                        overlapping, 
+                        bounds=(west, south, east, north), 
+                        res=res,
+                        nodata=nodata
+                    )
+                else:
+                    mosaic = np.full(
+                        (dest.count, window.height, window.width),
+                        nodata if nodata is not None else 0,
+                        dtype=dest.dtypes[0]
+                    )
+
+                dest.write(mosaic, window=window)
+
+        # Move the finished mosaic into place
+        os.replace(partpath, outpath)
+    finally:
+        for src in srcs:
+            src.close()
+        if os.path.exists(partpath):
+            os.remove(partpath)
+
+    return outpath
+
+
+def mosaic_up_to_date(fps, outpath):
+    """
+    Checks if the mosaic exists and is newer than all of its tiles.
+    Mosaics are moved into place only when finished, so one that exists
+    is complete
+    """
+    if not os.path.exists(outpath):
+        return False
+
+    return os.path.getmtime(outpath) >= max(
+        os.path.getmtime(fp) for fp in fps
+    )
+
+
+def mosaic_worker(job):
+    """
+    Builds one streamed mosaic inside a pool worker
+    """
+    fps, outpath, window_size = job
+
+    start = timeit.default_timer()
+    files_to_mosaic_windowed(fps, outpath, window_size)
+
+    return outpath, timeit.default_timer() - start
+
+
+def files_to_mosaic_batch(jobs, processes=2, window_size=512, 
+                          overwrite=False):
+    """
+    Builds many mosaics (e.g. one per river-year) at once. jobs is a 
+    list of (fps, outpath). At most processes mosaics are built at a 
+    time, each streamed window by window, so memory stays bounded. 
+    Mosaics newer than all of their tiles are skipped unless overwrite.
+    Returns the seconds each mosaic took (None if skipped)
+    """
+    timing = {}
+    todo = []
+    for fps, outpath in jobs:
+        if not fps:
+            continue
+        if not overwrite and mosaic_up_to_date(fps, outpath):
+            print('{o}: up to date'.format(o=outpath))
+            timing[outpath] = None
+            continue
+        todo.append((fps, outpath, window_size))
+
+    if not todo:
+        return timing
+
+    with multiprocessing.Pool(processes) as pool:
+        for outpath, seconds in pool.imap_unordered(mosaic_worker, todo):
+            print('{o}: {s:.1f} s'.format(o=outpath, s=seconds))
+            timing[outpath] = seconds
+
+    return timing
+
+
+# GDAL names of the numpy data types for the VRT
+GDAL_TYPES = {
+    'int8': 'Int8',
+    'uint8': 'Byte',
+    'uint16': 'UInt16',
+    'int16': 'Int16',
+    'uint32': 'UInt32',
+    'int32': 'Int32',
+    'float32': 'Float32',
+    'float64': 'Float64',
+}
+
+
+def files_to_vrt(fps, outpath=None):
+    """
+    Lazy (VRT) mosaic of the files. Nothing is merged or copied: the
+    returned dataset reads from the source tiles on demand, so it can go
+    straight to crop_to_mask, cleanRaster or the classifier. 
+    Where tiles overlap the first file wins, like files_to_mosaic. 
+    If outpath is given the (small) .vrt file is saved there, otherwise
+    the dataset only lives in memory
+    """
+    srcs = [rasterio.open(fp) for fp in fps]
+    try:
+        transform, width, height = mosaic_grid(srcs)
+        first = srcs[0]
+        res = first.res
+
+        vrt = ElementTree.Element(
+            'VRTDataset', 
+            rasterXSize=str(width), 
+            rasterYSize=str(height)
+        )
+        if first.crs is not None:
+            ElementTree.SubElement(vrt, 'SRS').text = first.crs.to_wkt()
+        ElementTree.SubElement(vrt, 'GeoTransform').text = ', '.join(
+            repr(float(v)) for v in transform.to_gdal()
+        )
+
+        for bidx in range(1, first.count + 1):
+            band = ElementTree.SubElement(
+                vrt, 
+                'VRTRasterBand', 
+                dataType=GDAL_TYPES[first.dtypes[bidx - 1]], 
+                band=str(bidx)
+            )
+            if first.descriptions[bidx - 1]:
+                description = ElementTree.SubElement(band, 'Description')
+                description.text = first.descriptions[bidx - 1]
+            if first.nodata is not None:
+                ElementTree.SubElement(band, 'NoDataValue').text = repr(
+                    first.nodata
+                )
+
+            # Later sources are drawn on top, so add the first file last
+            for src in reversed(srcs):
+                if first.nodata is not None:
+                    source = ElementTree.SubElement(band, 'ComplexSource')
+                else:
+                    source = ElementTree.SubElement(band, 'SimpleSource')
+                filename = ElementTree.SubElement(
+                    source, 
+                    'SourceFilename', 
+                    relativeToVRT='0'
+                )
+                filename.text = os.path.abspath(src.name)
+                ElementTree.SubElement(source, 'SourceBand').text = str(bidx)
+                ElementTree.SubElement(
+                    source, 
+                    'SrcRect', 
+                    xOff='0', 
+                    yOff='0', 
+                    xSize=str(src.width), 
+                    ySize=str(src.height)
+                )
+                ElementTree.SubElement(
+                    source, 
+                    'DstRect',
+                    xOff=repr((src.bounds.left - transform.c) / res[0]),
+                    yOff=repr((transform.f - src.bounds.top) / res[1]),
+                    xSize=repr(src.width * src.res[0] / res[0]),
+                    ySize=repr(src.height * src.res[1] / res[1])
+                )
+                if first.nodata is not None:
+                    ElementTree.SubElement(source, 'NODATA').text = repr(
+                        first.nodata
+                    )
+    finally:
+        for src in srcs:
+            src.close()
+
+    vrt_xml = ElementTree.tostring(vrt, encoding='unicode')
+
+    if outpath:
+        with open(outpath, 'w') as f:
+            f.write(vrt_xml)
+        return rasterio.open(outpath)
+
+    return rasterio.open(vrt_xml)
+
+
+def openRaster(fp):
+    """
+    Opens a raster path. Already open datasets (e.g. a virtual mosaic)
+    are passed straight through
+    """
+    if hasattr(fp, 'read'):
+        return fp
+
+    return rasterio.open(fp)
+
+
 def cleanRaster(fp, outpath):
-    ds = rasterio.open(fp)
+    ds = openRaster(fp)
     ds_meta = ds.meta.copy()
+    ds_meta.update({"driver": "GTiff"})
 
     ds = ds.read(1)
 
@@ -168,72 +489,184 @@ def cleanRaster(fp, outpath):
 
 def WaterIndex(red, swir):
     """
-    Discriminating index for identifying water
+    Discriminating index for identifying water. Works on whole band 
+    arrays in float32 and is 0 where red + swir is 0
     """
-    return (red - swir) / (red + swir)
+    red = np.asarray(red, dtype=np.float32)
+    swir = np.asarray(swir, dtype=np.float32)
+
+    top = red - swir
+    bottom = red + swir
+
+    index = np.zeros(top.shape, dtype=np.float32)
+    np.divide(top, bottom, out=index, where=bottom != 0)
 
+    return index
 
-def ImageConvert(image):
-    new_image = np.zeros(image.shape)
-    for idx, im in enumerate(image):
-        # Because I don't know what the no data value is I have to do this
-        # Setting up array where no data is 0
-        new_im = np.zeros(im.shape)
-        for i, row in enumerate(im):
-            for j, val in enumerate(row):
-                if val > 0:
-                    new_im[i, j] = val
 
-        # Get max in the band
-        band_max = new_im.max()
-        new_im = new_im / band_max
+def ImageConvert(image, inplace=False):
+    """
+    Normalizes each band of a (bands, rows, cols) image by its max.
+    Because I don't know what the no data value is, anything that isn't
+    > 0 is set to 0 first. Bands with no data stay 0.
+    Returns the transposed (cols, rows, bands) float32 image. With
+    inplace=True a floating point image is normalized in its own memory
+    (and keeps its dtype)
+    """
+    if inplace:
+        if not np.issubdtype(image.dtype, np.floating):
+            raise ValueError('inplace needs a floating point image')
+        new_image = image
+    else:
+        new_image = image.astype(np.float32)
+
+    # Setting up array where no data is 0
+    np.copyto(new_image, 0, where=~(new_image > 0))
 
-        # Save in the image
-        new_image[idx] = new_im
+    # Get max in each band
+    band_max = new_image.reshape(new_image.shape[0], -1).max(axis=1)
+    band_max = band_max[:, None, None]
+    np.divide(new_image, band_max, out=new_image, where=band_max > 0)
 
     return new_image.transpose()
 
 
+def labelDtype(npixels):
+    """
+    Smallest integer type that can hold the labels of npixels pixels
+    """
+    for dtype in (np.uint8, np.uint16, np.uint32):
+        if npixels < np.iinfo(dtype).max:
+            return dtype
+
+    return np.int64
+
+
+def labelCounts(labels, nlabels, chunksize=2**22):
+    """
+    Pixels in each label. Counted in chunks so that bincount never makes
+    a full size int64 copy of the label image
+    """
+    flat = labels.reshape(-1)
+    counts = np.zeros(nlabels + 1, dtype=np.int64)
+    for start in range(0, flat.size, chunksize):
+        counts += np.bincount(
+            flat[start:start + chunksize], 
+            minlength=nlabels + 1
+        )
+
+    return counts
+
+
+def largestComponent(mask, connectivity=2, downsample=None):
+    """
+    Finds the largest connected component of a mask (same as labelling 
+    with skimage.measure.label and taking the biggest label).
+    Labels with the smallest integer type and counts the labels once.
+    connectivity is 1 (4-connected) or 2 (8-connected).
+    With downsample=f the component is first located on a mask 
+    downsampled f times, and only its bounding box is labelled at full 
+    resolution. This is exact unless the largest full resolution 
+    component sits outside the largest downsampled one
+    """
+    mask = np.asarray(mask) != 0
+    structure = ndimage.generate_binary_structure(2, connectivity)
+
+    if downsample and downsample > 1:
+        # Block any() of the mask
+        f = downsample
+        h, w = mask.shape
+        ph, pw = -h % f, -w % f
+        proxy = np.pad(mask, ((0, ph), (0, pw))).reshape(
+            (h + ph) // f, f, (w + pw) // f, f
+        ).any(axis=(1, 3))
+
+        # Bounding box of the largest proxy component at full resolution
+        proxy_cc = largestComponent(proxy, connectivity)
+        rows = np.flatnonzero(proxy_cc.any(axis=1))
+        cols = np.flatnonzero(proxy_cc.any(axis=0))
+        r0, r1 = rows[0] * f, min((rows[-1] + 1) * f, h)
+        c0, c1 = cols[0] * f, min((cols[-1] + 1) * f, w)
+
+        largest = np.zeros(mask.shape, dtype=bool)
+        largest[r0:r1, c0:c1] = largestComponent(
+            mask[r0:r1, c0:c1], 
+            connectivity
+        )
+
+        return largest
+
+    labels = np.empty(mask.shape, dtype=labelDtype(np.count_nonzero(mask)))
+    nlabels = ndimage.label(mask, structure=structure, output=labels)
+    if nlabels == 0:
+        raise ValueError('Mask has no connected components')
+
+    counts = labelCounts(labels, nlabels)
+    counts[0] = 0
+
+    return labels == np.argmax(counts)
+
+
 def getLargestCC(combined_mask):
-    labels = label(combined_mask)
-     # assume at least 1 CC
-    assert( labels.max() != 0 )
-    largestCC = labels == np.argmax(np.bincount(labels.flat)[1:])+1
-    return largestCC
+    return largestComponent(combined_mask)
 
 
-def enhanceMask(image, mask):
+def waterIndexMask(image, mask):
+    """
+    Combines a water mask with the water index computed over the whole 
+    (bands, rows, cols) image. Pixels with no data (band 0 not > 0) or 
+    a non-finite index only take the mask value. 
+    Returns a (rows, cols) float32 0/1 mask
+    """
     # Calculate index over image
-    image = image.transpose()
-    mask = mask.transpose()
-    index_image = np.zeros((mask.shape[0], mask.shape[1]))
-    for i, row in enumerate(image):
-        for j, vals in enumerate(row):
-            if vals[0] > 0:
-                index_image[i, j] = WaterIndex(vals[3], vals[4])
-            else:
-                index_image[i, j] = 0
+    index_image = WaterIndex(image[3], image[4])
+    valid = (image[0] > 0) & np.isfinite(index_image)
 
+    # Combine the two masks
+    combined_mask = ((index_image > 0) & valid) | (mask > 0)
 
-    # convert to binrary
-    index_image[index_image < 0] = 0 
-    index_image[index_image > 0] = 1 
+    return combined_mask.astype(np.float32)
 
-    # Combine the two masks
-    mask = mask[:,:,0]
-    combined_mask = index_image + mask
 
-    # convert to binrary
-    combined_mask[combined_mask < 0] = 0 
-    combined_mask[combined_mask > 0] = 1 
+def enhanceMask(image, mask):
+    """
+    Combines the water mask with the water index. Takes the 
+    (bands, rows, cols) image and (1, rows, cols) mask and returns the
+    transposed (cols, rows, 1) combined mask
+    """
+    combined_mask = waterIndexMask(image, mask[0])
+
+    return combined_mask.transpose()[..., None]
 
-#    combined_mask = getLargestCC(combined_mask)
 
-    return combined_mask.reshape((
-        combined_mask.shape[0],
-        combined_mask.shape[1],
-        1
-    ))
+def enhanceMaskWindowed(imagepath, maskpath, outpath, window_size=None):
+    """
+    Streaming version of enhanceMask for mosaics that don't fit in 
+    memory. The image and mask must be on the same grid (paths or open
+    datasets). Each window is read, combined and written straight to 
+    outpath as a uint8 GeoTIFF
+    """
+    imageds = openRaster(imagepath)
+    maskds = openRaster(maskpath)
+    meta = maskds.meta.copy()
+    meta.update({'driver': 'GTiff', 'dtype': 'uint8', 'count': 1})
+    with rasterio.open(outpath, "w", **meta) as dest:
+        for window in iterWindows(maskds, window_size):
+            image = imageds.read(window=window)
+            mask = maskds.read(1, window=window)
+            dest.write(
+                waterIndexMask(image, mask).astype('uint8'), 
+                1, 
+                window=window
+            )
+
+    # Only close the datasets if we opened them
+    if imageds is not imagepath:
+        imageds.close()
+    if maskds is not maskpath:
+        maskds.close()
+
+    return outpath
 
 
 if __name__ == '__main__':
@@ -7,6 +7,7 @@ import cv2
 import pandas
 from shapely.geometry import box
 from skimage import measure
+from skimage.morphology import skeletonize, thin
 import geopandas as gpd
 from fiona.crs import from_epsg
 from pycrs import parse as crsparse
@@ -15,6 +16,9 @@ import rasterio
 from rasterio.plot import show
 from rasterio.plot import show_hist
 from rasterio.mask import mask
+from rasterio.windows import Window
+
+from PyRivers import RasterHelpers
 
 
 def crop_to_mask(ds):
@@ -98,6 +102,7 @@ def crop_to_mask(ds):
 #    )
 
     meta.update({
+        'driver': 'GTiff',
         'transform': out_transform,
         'width': out_img.shape[2],
         'height': out_img.shape[1],
@@ -106,6 +111,87 @@ def crop_to_mask(ds):
     return out_img[0, :, :], meta 
 
 
+def nonzero_bounds(ds, bidx=1, window_size=None):
+    """
+    Finds the bounding box of the non-zero pixels in a band by scanning
+    it one block (or window) at a time. Blocks that fall inside the box 
+    found so far can't grow it, so they aren't read
+    
+    INPUTS:      ds - rasterio dataset
+                 bidx - band index 
+                 window_size - fixed window size (default: file blocks)
+    
+    OUTPUTS:     (row_min, row_max, col_min, col_max) - inclusive, or 
+                 None if the band is all zeros
+    """
+    row_min, col_min = ds.height, ds.width
+    row_max, col_max = -1, -1
+    for window in RasterHelpers.iterWindows(ds, window_size):
+        row_off, col_off = int(window.row_off), int(window.col_off)
+        height, width = int(window.height), int(window.width)
+
+        # Skip blocks inside the current box
+        if (
+            row_off >= row_min and row_off + height - 1 <= row_max
+            and col_off >= col_min and col_off + width - 1 <= col_max
+        ):
+            continue
+
+        block = ds.read(bidx, window=window)
+        rows = numpy.flatnonzero(block.any(axis=1))
+        if not len(rows):
+            continue
+        cols = numpy.flatnonzero(block.any(axis=0))
+
+        row_min = min(row_min, row_off + rows[0])
+        row_max = max(row_max, row_off + rows[-1])
+        col_min = min(col_min, col_off + cols[0])
+        col_max = max(col_max, col_off + cols[-1])
+
+    if row_max < 0:
+        return None
+
+    return row_min, row_max, col_min, col_max
+
+
+def crop_to_mask_windowed(ds, bidx=1, window_size=None):
+    """
+    Crops a mask to the bounding box of its non-zero pixels without
+    reading the full band into memory. Only the cropped window is read
+    
+    INPUTS:      ds - rasterio dataset
+                 bidx - band index 
+                 window_size - fixed window size for the scan
+    
+    OUTPUTS:     out_img - cropped image array 
+                 meta - updated geotiff meta (with the cropped transform)
+    """
+    meta = ds.meta.copy()
+
+    bounds = nonzero_bounds(ds, bidx, window_size)
+    if bounds is None:
+        raise ValueError('Mask has no non-zero pixels')
+    row_min, row_max, col_min, col_max = bounds
+
+    # Read only the cropped window
+    window = Window(
+        col_min, 
+        row_min, 
+        col_max - col_min + 1, 
+        row_max - row_min + 1
+    )
+    out_img = ds.read(bidx, window=window)
+
+    meta.update({
+        'driver': 'GTiff',
+        'transform': ds.window_transform(window),
+        'width': out_img.shape[1],
+        'height': out_img.shape[0],
+    })
+
+    return out_img, meta
+
+
 def add_buffer(image, meta):
     """
     Adds 1 pixel buffer around the image file. Then updates that affine
@@ -141,7 +227,7 @@ def add_buffer(image, meta):
     affine[5] = affine[5] - affine[4]
 
     # Update meta data
-    meta['transform'] = Affine.from_gdal(*tuple(affine))
+    meta['transform'] = Affine(*affine)
 
     # Reshape
     image = image[None, ...]
@@ -188,43 +274,99 @@ def fill_holes(image, meta):
     return image, meta
 
 
-def centerline_from_mask(image, meta):
+def crop_pad_fill(ds, pad=1, bidx=1, window_size=None):
     """
-    Finds centerline from mask. Could implement this if I'm feeling bold at
-    some point
+    Does crop_to_mask, add_buffer and fill_holes in one step. The padded
+    output is allocated once, the cropped window is read straight into
+    it, the holes are flood filled in place and the affine is updated 
+    once. Gives the same 0/255 image as fill_holes
+    
+    INPUTS:      ds - rasterio dataset
+                 pad - width of the zero buffer (pixels, at least 1)
+                 bidx - band index
+                 window_size - fixed window size for the scan
+
+    OUTPUTS:     out_img - cropped, buffered and filled image array
+                 meta - updated geotiff meta
+    """
+    # The flood starts in the corner, which is only background in the pad
+    if pad < 1:
+        raise ValueError('pad must be at least 1 pixel')
+
+    meta = ds.meta.copy()
 
-    NOT DONE
+    bounds = nonzero_bounds(ds, bidx, window_size)
+    if bounds is None:
+        raise ValueError('Mask has no non-zero pixels')
+    row_min, row_max, col_min, col_max = bounds
+    window = Window(
+        col_min, 
+        row_min, 
+        col_max - col_min + 1, 
+        row_max - row_min + 1
+    )
+    h, w = int(window.height), int(window.width)
+
+    # Allocate the padded image once and read the crop into it
+    image = numpy.zeros((h + 2 * pad, w + 2 * pad), numpy.uint8)
+    crop = image[pad:pad + h, pad:pad + w]
+    if ds.dtypes[bidx - 1] == 'uint8':
+        ds.read(bidx, window=window, out=crop)
+    else:
+        crop[...] = ds.read(bidx, window=window) != 0
+
+    # Flood fill the background from the corner into the mask only
+    flood_mask = numpy.zeros((h + 2 * pad + 2, w + 2 * pad + 2), numpy.uint8)
+    cv2.floodFill(
+        image, 
+        flood_mask, 
+        (0, 0), 
+        255, 
+        flags=4 | cv2.FLOODFILL_MASK_ONLY | (1 << 8)
+    )
+
+    # Everything the flood didn't reach is channel
+    image[...] = 255
+    image[flood_mask[1:-1, 1:-1].view(bool)] = 0
+
+    # Update affine transformation (shift west and north by the buffer)
+    meta.update({
+        'driver': 'GTiff',
+        'dtype': 'uint8',
+        'transform': (
+            ds.window_transform(window) * Affine.translation(-pad, -pad)
+        ),
+        'width': image.shape[1],
+        'height': image.shape[0],
+    })
+
+    return image[None, ...], meta
+
+
+def centerline_from_mask(image, meta):
+    """
+    Finds the centerline from a mask. Only the largest connected area is
+    kept (RasterHelpers.largestComponent) and then it is skeletonized the
+    same way as Centerline.getCenterline
     
     INPUTS:      image - Image data array 
                  meta - geotiff meta data
     
-    OUTPUTS:     out_img - cropped image array 
-                 meta - updated geotiff meta 
+    OUTPUTS:     centerline - boolean centerline array 
+                 meta - geotiff meta 
     """
 
     # Reduce dimension of image
     image = image[0, :, :]
 
-    # Get image shape
-    h, w = image.shape
-
     # Remove any spurious small patches by only keeping the largest area
-    labels = measure.label(image)
-    props = pandas.DataFrame(measure.regionprops_table(
-        labels, 
-        properties=(
-            'area',
-            'coords',
-        )
-    ))
-    largest_prop = props[props['area'] == numpy.max(props['area'])]
-    largest_coords = list(largest_prop['coords'])
-
-    image = numpy.zeros(image.shape)
-    for coord in largest_coords[0]:
-        image[coord[0], coord[1]] = 1
-
-    return image[0, :, :], meta
+    largest = RasterHelpers.largestComponent(image)
+
+    # Skeletonize
+    centerline = skeletonize(largest, method='lee')
+    centerline = thin(centerline)
+
+    return centerline[None, ...], meta
 
 
 if __name__ == "__main__":
@@ -19,15 +19,12 @@ from shapely import ops
 import geopandas as gpd
 
 from PyRivers import Centerline 
+from PyRivers import RasterHelpers
 
 
 def cleanChannel(image):
-    labels = measure.label(image)
-     # assume at least 1 CC
-    assert( labels.max() != 0 )
     # Find largest connected component
-    bins = np.bincount(labels.flat)[1:] 
-    channel = labels == np.argmax(np.bincount(labels.flat)[1:])+1
+    channel = RasterHelpers.largestComponent(image)
     channel = Centerline.fillHoles(channel)
 
     return channel
@@ -138,7 +135,8 @@ def intersectionWidth(segment, cross_section, river_poly):
 
 def sortCenterline(centerline_i):
     """
-    This method unfortunately reduces the centerline to a single path
+    This method unfortunately reduces the centerline to a single path.
+    Centerline.orderCenterline orders a centerline raster without networkx
     """
     G = nx.Graph()
     tree = KDTree(centerline_i, leaf_size=2, metric='euclidean')  # Create a distance tree
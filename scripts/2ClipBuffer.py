@@ -32,10 +32,7 @@ for year in range(2004, 2022, 2):
         print(opath)
 
         ds = rasterio.open(fp)
-        image = ds.read()
-        meta = ds.meta.copy()
-
-        image, meta = RivMap.crop_to_mask(ds)
+        image, meta = RivMap.crop_to_mask_windowed(ds)
 
         if not os.path.exists(rootdir):
             os.makedirs(rootdir)
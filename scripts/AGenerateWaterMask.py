@@ -9,35 +9,41 @@ pattern = '(.*)\/(\w*)\/.*\/(\d{4})\/(\w*)\/'
 root = '/Users/greenberg/Documents/PHD/Projects/BarT/RiverData/brazos/**'
 inname = '*image.tif'
 inpath = os.path.join(root, inname)
-fps = glob.glob(inpath, recursive=True)
-
-for i, fp in enumerate(fps):
-    regex = re.search(pattern, fp)
-    root = regex.group(1)
-    river = regex.group(2)
-    year = regex.group(3)
-    idx = regex.group(4)
-
-    if i == 0:
-        clf = Classification.generateTree(fp)
-        clfpath = os.path.join(
+
+if __name__ == '__main__':
+    fps = glob.glob(inpath, recursive=True)
+
+    opaths = []
+    for i, fp in enumerate(fps):
+        regex = re.search(pattern, fp)
+        root = regex.group(1)
+        river = regex.group(2)
+        year = regex.group(3)
+        idx = regex.group(4)
+
+        if i == 0:
+            clf = Classification.generateTree(fp)
+            clfpath = os.path.join(
+                root,
+                river,
+                f'{river}_clf.joblib.pkl'
+            )
+            joblib.dump(clf, clfpath, compress=9)
+
+        oroot = os.path.join(
             root,
             river,
-            f'{river}_clf.joblib.pkl'
+            'mask',
+            year,
+            idx
         )
-        joblib.dump(clf, clfpath, compress=9)
-
-    oroot = os.path.join(
-        root,
-        river,
-        'mask',
-        year,
-        idx
-    )
-    oname = f'{river}_{year}_1_mask.tif'
-    opath = os.path.join(oroot, oname)
-
-    if not os.path.exists(oroot):
-        os.makedirs(oroot)
-        
-    prediction = Classification.predictPixels(fp, opath, clf)
+        oname = f'{river}_{year}_1_mask.tif'
+        opath = os.path.join(oroot, oname)
+
+        if not os.path.exists(oroot):
+            os.makedirs(oroot)
+
+        opaths.append(opath)
+
+    # Classify all of the scenes in parallel
+    throughput = Classification.predictScenes(fps, opaths, clf)
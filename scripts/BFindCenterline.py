@@ -34,34 +34,15 @@ for i, fp in enumerate(fps):
     image = Centerline.fillHoles(image)
     raw_centerline = Centerline.getCenterline(image)
 
-    thresh = 100
-    close_points = False 
-    while not close_points:
-        print('Trying threshold: ', thresh)
-        centerline, river_endpoints = Centerline.cleanCenterline(
-            raw_centerline, 
-            es, 
-            thresh 
-        )
-        centerline = Centerline.getLargest(centerline)
-
-        close_points = Centerline.getCenterlineExtent(
-            centerline, 
-            river_endpoints,
-            maxdistance=50
-        )
-        print(close_points)
-        thresh -= 10
-
-    # Use the found threshold
-    thresh = thresh + 10
-    print('Using threshold: ', thresh)
-    centerline, river_endpoints = Centerline.cleanCenterline(
+    # Largest threshold that still reaches both river ends
+    centerline, river_endpoints, thresh = Centerline.cleanCenterlineSweep(
         raw_centerline, 
         es, 
-        thresh
+        thresh=100,
+        step=10,
+        maxdistance=50
     )
-    centerline = Centerline.getLargest(centerline)
+    print('Using threshold: ', thresh)
 
 #    # QA Plotting
 #    fig, axes = plt.subplots(
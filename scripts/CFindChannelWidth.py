@@ -8,6 +8,7 @@ import pandas
 import numpy
 from shapely import geometry
 from PyRivers import Width
+from PyRivers import Centerline
 
 
 pattern = '(.*)\/(\w*)\/.*\/(\d{4})\/(\w*)\/'
@@ -18,6 +19,8 @@ inname = '*centerline.tif'
 inpath = os.path.join(root, inname)
 fps = glob.glob(inpath, recursive=True)
 
+es = 'NS'
+
 for i, fp in enumerate(fps):
     # Find components of the path
     regex = re.search(pattern, fp)
@@ -49,26 +52,14 @@ for i, fp in enumerate(fps):
     conversion = (111.32/.001) * ds.transform[0]
     width_df['width_m'] = width_df['width'] * conversion
 
-    centerline_i = numpy.array(width_df[['rowi', 'coli']])
-    centerline_i = Width.sortCenterline(centerline_i)
-    data = {
-        'row': [],
-        'col': [],
-        'lat': [],
-        'lon': [],
-        'width': []
-    }
-    for idx, row in enumerate(centerline_i):
-        match = width_df[
-            (width_df['rowi'] == row[0])
-            & (width_df['coli'] == row[1])
-        ]
-        data['row'].append(match['rowi'].iloc[0])
-        data['col'].append(match['coli'].iloc[0])
-        data['lat'].append(match['lat'].iloc[0])
-        data['lon'].append(match['lon'].iloc[0])
-        data['width'].append(match['width'])
-    centerline_df = pandas.DataFrame(data)
+    # Order the centerline pixels from upstream to downstream
+    centerline_i = Centerline.orderCenterline(centerline, es)
+    # getWidths stores the column in rowi and the row in coli
+    order = pandas.DataFrame(centerline_i[:, ::-1], columns=['rowi', 'coli'])
+    centerline_df = order.merge(width_df, on=['rowi', 'coli'])
+    centerline_df = centerline_df.rename(
+        columns={'rowi': 'row', 'coli': 'col'}
+    )[['row', 'col', 'lat', 'lon', 'width']]
 
     oroot = os.path.join(
         root,